@@ -0,0 +1,142 @@
+"""
+Dynamic Request Batching
+========================
+
+Collects concurrent compression requests for a few milliseconds and runs
+them through ScratchCompressor together, so they share batched encoder
+forward passes instead of each paying for its own.
+
+The compressor is not thread-safe (attention is accumulated on the scorer
+during a forward pass), so all model work runs on one worker thread, one
+batch at a time, keeping the event loop free.
+"""
+
+import asyncio
+from typing import Optional, List, Tuple
+
+from .scratch import ScratchCompressor, CompressionResult
+
+
+# (text, query, target_ratio, future)
+_Request = Tuple[str, Optional[str], Optional[float], asyncio.Future]
+
+
+class BatchingCompressor:
+    """
+    Async front end for a ScratchCompressor with dynamic micro-batching.
+
+    Requests are drained from a queue up to ``max_batch`` at a time, waiting
+    at most ``max_wait`` seconds after the first one for others to arrive.
+    """
+
+    def __init__(
+        self,
+        compressor: ScratchCompressor,
+        max_batch: int = 16,
+        max_wait: float = 0.01
+    ):
+        self.compressor = compressor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer: Optional[asyncio.Task] = None
+
+    async def compress(
+        self,
+        text: str,
+        query: Optional[str] = None,
+        target_ratio: Optional[float] = None
+    ) -> CompressionResult:
+        """Queue one request and wait for its batch to finish."""
+        if self._consumer is None or self._consumer.done():
+            # Created lazily so both are bound to the running event loop
+            self._queue = asyncio.Queue()
+            self._consumer = asyncio.create_task(self._consume())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, query, target_ratio, future))
+        return await future
+
+    async def close(self):
+        """
+        Finish the requests already queued, then stop the consumer task. Once
+        this returns no model work is running, so the compressor's caches can
+        be saved safely.
+        """
+        if self._consumer is not None and not self._consumer.done():
+            await self._queue.put(None)
+            await self._consumer
+        self._consumer = None
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    # close(): run what was collected, then stop
+                    stopping = True
+                    break
+                batch.append(request)
+
+            # Skip requests whose callers have gone away
+            batch = [request for request in batch if not request[3].done()]
+            if not batch:
+                continue
+
+            try:
+                results = await asyncio.to_thread(self._run_batch, batch)
+            except Exception:
+                # Retry each request on its own so only the one that fails
+                # gets the exception
+                results = []
+                for request in batch:
+                    try:
+                        results.append((await asyncio.to_thread(self._run_batch, [request]))[0])
+                    except Exception as e:
+                        results.append(e)
+
+            for (*_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _run_batch(self, batch: List[_Request]) -> List[CompressionResult]:
+        """
+        Compress one batch on the worker thread. Texts that fit in one
+        encoder pass share batched forward passes; longer texts go through
+        compress_chunks, which batches their chunks itself, so nothing is
+        truncated.
+        """
+        results = [None] * len(batch)
+
+        short = [i for i, (text, *_) in enumerate(batch) if self.compressor.fits_encoder(text)]
+        if short:
+            compressed = self.compressor.compress_batch(
+                [batch[i][0] for i in short],
+                queries=[batch[i][1] for i in short],
+                target_ratios=[batch[i][2] for i in short]
+            )
+            for i, result in zip(short, compressed):
+                results[i] = result
+
+        for i, (text, query, target_ratio, _) in enumerate(batch):
+            if results[i] is None:
+                results[i] = self.compressor.compress_chunks(text, query, target_ratio)
+
+        return results
@@ -1,20 +1,23 @@
 import os
 import re
 import time
+import asyncio
+import hashlib
+import shelve
 import torch
 import numpy as np
 import pandas as pd
-import tiktoken
-import requests
+import aiohttp
 import dotenv
 from datasets import load_dataset
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer, AutoModel
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from huggingface_hub import login
 from llmlingua import PromptCompressor
 import tokenc
+from scratch import ScratchCompressor, CompressorConfig, get_token_encoder
 
 # ---------------------------------------------------------
 # 1. Setup & Config
@@ -27,11 +30,20 @@ if HF_TOKEN:
 device = "mps" if torch.backends.mps.is_available() else "cuda"
 
 # Token Counter Fix: pass disallowed_special=() to ignore errors
-token_encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+# (same encoder instance as the scratch compressor's token counter)
+token_encoder = get_token_encoder()
+FILTER_BATCH_SIZE = 32   # Texts per tiktoken encode_batch call when counting tokens
 
-def count_tokens(text: str) -> int:
-    """Returns token count, allowing special tokens like <|endoftext|>."""
-    return len(token_encoder.encode(text, disallowed_special=()))
+def token_lengths(texts) -> list:
+    """
+    Token counts of texts, allowing special tokens like <|endoftext|>.
+    Encoded FILTER_BATCH_SIZE at a time, keeping only the lengths.
+    """
+    lengths = []
+    for start in range(0, len(texts), FILTER_BATCH_SIZE):
+        encoded = token_encoder.encode_batch(texts[start:start + FILTER_BATCH_SIZE], disallowed_special=())
+        lengths.extend(len(tokens) for tokens in encoded)
+    return lengths
 
 # ---------------------------------------------------------
 # 2. Model Loading
@@ -40,7 +52,6 @@ def count_tokens(text: str) -> int:
 ttc_client = tokenc.TokenClient(api_key=os.getenv("TOKEN_API_KEY"))
 
 # From-scratch compressor
-from scratch import ScratchCompressor, CompressorConfig
 scratch_config = CompressorConfig(target_ratio=0.34)
 scratch_compressor = ScratchCompressor(scratch_config)
 
@@ -55,73 +66,121 @@ scratch_minilm_compressor = ScratchCompressor(scratch_minilm_config)
 # ---------------------------------------------------------
 # 3. OpenRouter API for LLM calls
 # ---------------------------------------------------------
-def call_openrouter(prompt: str, model: str = "google/gemini-3-flash-preview") -> str:
-    """Call OpenRouter API with given prompt."""
-    response = requests.post(
-        url="https://openrouter.ai/api/v1/chat/completions",
-        headers={
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        },
-        json={
-            "model": model,
-            "messages": [{"role": "user", "content": prompt}],
-            "max_tokens": 20,
-            "temperature": 0,
-        }
-    )
-    
-    if response.status_code != 200:
-        raise Exception(f"OpenRouter API error: {response.status_code} - {response.text}")
-    
-    return response.json()["choices"][0]["message"]["content"].strip()
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+MAX_CONCURRENT_REQUESTS = 16   # Bounded by provider rate limits
+MAX_RETRIES = 3
+
+async def call_openrouter_async(
+    session: aiohttp.ClientSession,
+    prompt: str,
+    sem: asyncio.Semaphore,
+    model: str = "google/gemini-3-flash-preview"
+) -> str:
+    """Call OpenRouter API with given prompt, retrying with exponential backoff."""
+    async with sem:
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with session.post(
+                    url=OPENROUTER_URL,
+                    headers={
+                        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                        "Content-Type": "application/json",
+                    },
+                    json={
+                        "model": model,
+                        "messages": [{"role": "user", "content": prompt}],
+                        "max_tokens": 20,
+                        "temperature": 0,
+                    }
+                ) as response:
+                    if response.status != 200:
+                        raise Exception(f"OpenRouter API error: {response.status} - {await response.text()}")
+                    data = await response.json()
+                return data["choices"][0]["message"]["content"].strip()
+            except Exception:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
 
 # ---------------------------------------------------------
 # 3. Compression Functions
 # ---------------------------------------------------------
 
 
+TTC_AGGRESSIVENESS = 0.9
+
 def ttc_compress(context: str):
-    settings = tokenc.CompressionSettings(aggressiveness=0.9)
-    try:
-        res = ttc_client.compress_input(input=context, compression_settings=settings)
-        return res.output
-    except Exception as e:
-        print(f"TTC API error: {e}, returning original")
-        return context
+    """Compress with the Bear-1 API. Raises on API errors (see with_fallback)."""
+    settings = tokenc.CompressionSettings(aggressiveness=TTC_AGGRESSIVENESS)
+    res = ttc_client.compress_input(input=context, compression_settings=settings)
+    return res.output
+
+def with_fallback(func_name: str, func):
+    """Return the original context when compression fails."""
+    def wrapper(context: str, question: str) -> str:
+        try:
+            return func(context, question)
+        except Exception as e:
+            print(f"{func_name} error: {e}, returning original")
+            return context
+    
+    return wrapper
 
 def scratch_compress(context: str, query: str = None) -> str:
     """Use our from-scratch compressor with chunking for long texts."""
-    # Use compress_chunks for long contexts (> 500 words)
-    word_count = len(context.split())
-    if word_count > 500:
-        result = scratch_compressor.compress_chunks(context, query=query)
-    else:
-        result = scratch_compressor.compress(context, query=query)
-    return result.compressed_text
+    # Chunks contexts longer than one encoder pass
+    return scratch_compressor.compress_document(context, query=query).compressed_text
 
 def scratch_compress_qa(context: str, question: str) -> str:
     """Query-aware scratch compression with chunking for long texts."""
-    # Use compress_chunks for long contexts (> 500 words)
-    word_count = len(context.split())
-    if word_count > 500:
-        result = scratch_compressor.compress_chunks(context, query=question)
-    else:
-        result = scratch_compressor.compress(context, query=question)
-    return result.compressed_text
+    # Chunks contexts longer than one encoder pass
+    return scratch_compressor.compress_document(context, query=question).compressed_text
 
 def scratch_compress_minilm(context: str, query: str = None) -> str:
     """MiniLM-based scratch compression (3x smaller model, faster inference)."""
-    word_count = len(context.split())
-    if word_count > 500:
-        result = scratch_minilm_compressor.compress_chunks(context, query=query)
-    else:
-        result = scratch_minilm_compressor.compress(context, query=query)
-    return result.compressed_text
+    return scratch_minilm_compressor.compress_document(context, query=query).compressed_text
+
+COMPRESS_CACHE_PATH = "./cache/compress"
+
+def cached_compress(func_name: str, func, settings: str = ""):
+    """
+    Wrap a compression function with a persistent on-disk cache keyed by
+    SHA-256 of (func_name, settings, context, question), so reruns skip
+    re-compression. ``settings`` identifies the compressor configuration
+    (e.g. a CompressorConfig repr), so changing it invalidates old entries.
+    Exceptions propagate and are never cached.
+    """
+    os.makedirs(os.path.dirname(COMPRESS_CACHE_PATH), exist_ok=True)
+    
+    def wrapper(context: str, question: str) -> str:
+        key = hashlib.sha256(
+            "\0".join((func_name, settings, context, question or "")).encode()
+        ).hexdigest()
+        with shelve.open(COMPRESS_CACHE_PATH) as cache:
+            if key in cache:
+                return cache[key]
+        result = func(context, question)
+        with shelve.open(COMPRESS_CACHE_PATH) as cache:
+            cache[key] = result
+        return result
+    
+    return wrapper
 
 # ---------------------------------------------------------
 # 5. Evaluation Pipeline
 # ---------------------------------------------------------
+# Answer-extraction patterns, tried in order on the upper-cased response
+_ANSWER_PATTERNS = [re.compile(p) for p in (
+    r'\(([A-D])\)',           # (A), (B), etc.
+    r'\b([A-D])\.',           # A., B., etc.
+    r'OPTION[:\s]*\(?([A-D])\)?',   # "option: A" or "option (A)"
+    r'ANSWER[:\s]*\(?([A-D])\)?',   # "answer: A" or "answer (A)"
+    r'CORRECT[^A-D]*([A-D])',        # "correct option is A"
+    r'^\s*([A-D])\b',               # starts with letter
+    r'\b([A-D])\b',                 # standalone A, B, etc. (last resort)
+)]
+_MD_RE = re.compile(r'\*+')
+
 def verify_answer(predicted: str, gold: str) -> bool:
     print(predicted)
     """
@@ -129,7 +188,7 @@ def verify_answer(predicted: str, gold: str) -> bool:
     Extracts single letter A-D from the response.
     """
     # Remove markdown formatting
-    predicted_clean = re.sub(r'\*+', '', predicted)  # Remove * and **
+    predicted_clean = _MD_RE.sub('', predicted)  # Remove * and **
     predicted_upper = predicted_clean.upper().strip()
     gold_upper = gold.upper().strip()
     print(f"Predicted: {predicted_upper}, Answer: {gold_upper}")
@@ -139,34 +198,107 @@ def verify_answer(predicted: str, gold: str) -> bool:
         return predicted_upper == gold_upper
     
     # Try to find letter in various patterns
-    patterns = [
-        r'\(([A-D])\)',           # (A), (B), etc.
-        r'\b([A-D])\.',           # A., B., etc.
-        r'OPTION[:\s]*\(?([A-D])\)?',   # "option: A" or "option (A)"
-        r'ANSWER[:\s]*\(?([A-D])\)?',   # "answer: A" or "answer (A)"
-        r'CORRECT[^A-D]*([A-D])',        # "correct option is A"
-        r'^\s*([A-D])\b',               # starts with letter
-        r'\b([A-D])\b',                 # standalone A, B, etc. (last resort)
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, predicted_upper)
+    for pattern in _ANSWER_PATTERNS:
+        match = pattern.search(predicted_upper)
         if match:
             return match.group(1) == gold_upper
     
     return False
 
-def run_longbench_eval(sample_first_x=None, max_token_limit=100000):
+def build_prompt(item, compressed_context: str) -> str:
+    return (
+        f"Context:\n{compressed_context}\n\nQuestion: {item['question']}\n"
+        f"Options:\n(A) {item['choice_A']}\n(B) {item['choice_B']}\n(C) {item['choice_C']}\n(D) {item['choice_D']}\n\n"
+        f"Answer with ONLY the letter (A), (B), (C), or (D). Do NOT reply with anything other than the answer choice."
+    )
+
+def _timed_compress(func, item):
+    compress_start = time.time()
+    compressed_context = func(item['context'], item['question'])
+    return compressed_context, time.time() - compress_start
+
+async def _pipeline(func, items):
+    """
+    Compress samples on a single worker thread and feed them through a queue
+    to a pool of API consumers, so compression of sample i+1 overlaps the API
+    call for sample i.
+    
+    Returns (compressed contexts, compression times, responses) in sample order.
+    Failed API calls are returned as exceptions.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    n = len(items)
+    compressed, times, responses = [None] * n, [0.0] * n, [None] * n
+    
+    async def produce(executor):
+        for i, item in enumerate(items):
+            compressed[i], times[i] = await loop.run_in_executor(executor, _timed_compress, func, item)
+            await queue.put(i)
+        for _ in range(MAX_CONCURRENT_REQUESTS):
+            await queue.put(None)
+    
+    async def consume(session):
+        while (i := await queue.get()) is not None:
+            try:
+                responses[i] = await call_openrouter_async(session, build_prompt(items[i], compressed[i]), sem)
+            except Exception as e:
+                responses[i] = e
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(
+                produce(executor),
+                *[consume(session) for _ in range(MAX_CONCURRENT_REQUESTS)]
+            )
+    
+    return compressed, times, responses
+
+FILTER_CACHE_DIR = "./cache"
+
+def filter_by_token_limit(ds, max_token_limit: int):
+    """
+    Keep items whose context fits in max_token_limit tokens.
+    
+    Returns (items, context token lengths). The kept indices and lengths
+    are cached on disk per (dataset fingerprint, limit), so reruns skip
+    tokenizing every context.
+    """
+    key = hashlib.sha256(f"{ds._fingerprint}|{len(ds)}|{max_token_limit}".encode()).hexdigest()[:16]
+    cache_path = os.path.join(FILTER_CACHE_DIR, f"filter_{key}.npz")
+    
+    if os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        valid_indices, orig_lens = cached["indices"].tolist(), cached["lengths"].tolist()
+    else:
+        # Batch-encode contexts (tiktoken threads across each batch); keep only the lengths
+        context_lengths = []
+        for start in tqdm(range(0, len(ds), FILTER_BATCH_SIZE)):
+            contexts = ds[start:start + FILTER_BATCH_SIZE]['context']
+            encoded = token_encoder.encode_batch(contexts, disallowed_special=())
+            context_lengths.extend(len(tokens) for tokens in encoded)
+        
+        valid_indices = [i for i, length in enumerate(context_lengths) if length <= max_token_limit]
+        orig_lens = [context_lengths[i] for i in valid_indices]
+        
+        os.makedirs(FILTER_CACHE_DIR, exist_ok=True)
+        np.savez(cache_path, indices=np.array(valid_indices, dtype=np.int32), lengths=np.array(orig_lens, dtype=np.int32))
+    
+    return [ds[i] for i in valid_indices], orig_lens
+
+def run_longbench_eval(sample_first_x=None, max_token_limit=100000, use_cache=False):
     print("Loading LongBench-v2...")
     ds = load_dataset("THUDM/LongBench-v2", split='train')
     
     print(f"Filtering contexts > {max_token_limit} tokens...")
-    valid_data = [item for item in tqdm(ds) if count_tokens(item['context']) <= max_token_limit]
+    valid_data, orig_lens = filter_by_token_limit(ds, max_token_limit)
     
     print(f'{len(valid_data)} remaining longbench items after filtering')
 
     if sample_first_x:
         valid_data = valid_data[:sample_first_x]
+        orig_lens = orig_lens[:sample_first_x]
     
     print(f"Evaluating {len(valid_data)} samples.")
     
@@ -178,45 +310,61 @@ def run_longbench_eval(sample_first_x=None, max_token_limit=100000):
         #"scratch": lambda ctx, q: scratch_compress(ctx),
         #"scratch-MiniLM": lambda ctx, q: scratch_compress_minilm(ctx, query=q),  # Query-aware compression
     }
+    
+    # Optionally cache compressor outputs across runs. Off by default: cache
+    # hits report near-zero latency, so latency columns only mean something
+    # on a cold run
+    if use_cache:
+        cache_settings = {
+            "ttc (Bear-1)": f"aggressiveness={TTC_AGGRESSIVENESS}",
+            "scratch qa": repr(scratch_config),
+            "scratch": repr(scratch_config),
+            "scratch-MiniLM": repr(scratch_minilm_config),
+        }
+        configs = {
+            name: func if name == "Baseline" else cached_compress(name, func, cache_settings.get(name, ""))
+            for name, func in configs.items()
+        }
+    
+    # Bear-1 API failures fall back to the original context outside the cache,
+    # so an outage is not recorded as a 0% reduction on every later run
+    if "ttc (Bear-1)" in configs:
+        configs["ttc (Bear-1)"] = with_fallback("TTC API", configs["ttc (Bear-1)"])
 
     summary_results = []
 
     for name, func in configs.items():
         print(f"\n[Config: {name}]")
         correct, total_saved_pct = 0, []
-        total_compression_time = 0.0
         n_samples = len(valid_data)
         
-        for i, item in enumerate(valid_data):
-            # Time the compression
-            compress_start = time.time()
-            compressed_context = func(item['context'], item['question'])
-            compress_end = time.time()
-            total_compression_time += (compress_end - compress_start)
-            
-            orig_len = count_tokens(item['context'])
-            comp_len = count_tokens(compressed_context)
+        # Compression (timed per sample) overlaps with in-flight API calls
+        compressed_contexts, compression_times, responses = asyncio.run(_pipeline(func, valid_data))
+        
+        # Outputs that are the context itself (Baseline, API fallbacks) reuse
+        # its known length; only the others are tokenized
+        comp_lens = list(orig_lens)
+        changed = [i for i, item in enumerate(valid_data) if compressed_contexts[i] != item['context']]
+        for i, length in zip(changed, token_lengths([compressed_contexts[i] for i in changed])):
+            comp_lens[i] = length
+        
+        for i, (item, response) in enumerate(zip(valid_data, responses)):
+            orig_len, comp_len = orig_lens[i], comp_lens[i]
             total_saved_pct.append(1 - (comp_len / orig_len) if orig_len > 0 else 0)
             
-            prompt = (
-                f"Context:\n{compressed_context}\n\nQuestion: {item['question']}\n"
-                f"Options:\n(A) {item['choice_A']}\n(B) {item['choice_B']}\n(C) {item['choice_C']}\n(D) {item['choice_D']}\n\n"
-                f"Answer with ONLY the letter (A), (B), (C), or (D). Do NOT reply with anything other than the answer choice."
-            )
-            
-            try:
-                response = call_openrouter(prompt)
-                if verify_answer(response, item['answer']):
-                    correct += 1
-            except Exception as e:
-                print(f"API Error: {e}")
+            if isinstance(response, Exception):
+                print(f"API Error: {response}")
+            elif verify_answer(response, item['answer']):
+                correct += 1
             
             # Print running results after each question
             running_accuracy = (correct / (i + 1)) * 100
             running_reduction = np.mean(total_saved_pct) * 100
-            running_latency = total_compression_time / (i + 1)
-            print(f"  [{i+1}/{n_samples}] Acc: {running_accuracy:.1f}% | Reduction: {running_reduction:.1f}% | Avg Latency: {running_latency:.2f}s | Total Time: {total_compression_time:.1f}s")
+            running_time = sum(compression_times[:i + 1])
+            running_latency = running_time / (i + 1)
+            print(f"  [{i+1}/{n_samples}] Acc: {running_accuracy:.1f}% | Reduction: {running_reduction:.1f}% | Avg Latency: {running_latency:.2f}s | Total Time: {running_time:.1f}s")
 
+        total_compression_time = sum(compression_times)
         accuracy = (correct / len(valid_data)) * 100
         avg_reduction = np.mean(total_saved_pct) * 100
         avg_latency = total_compression_time / len(valid_data)
@@ -234,6 +382,8 @@ def run_longbench_eval(sample_first_x=None, max_token_limit=100000):
     df = pd.DataFrame(summary_results).drop(columns=['raw_acc'])
     print("\n" + "="*60 + "\nLONGBENCH-V2 COMPRESSION BENCHMARK\n" + "="*60)
     print(df.to_string(index=False))
+    if use_cache:
+        print("\nNote: compression outputs were cached; latencies include cache hits.")
 
 if __name__ == "__main__":
     import sys
@@ -20,12 +20,17 @@ Architecture:
 
 import os
 import re
+import hashlib
+import contextlib
+import tempfile
+import threading
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-from typing import Optional, List, Tuple, Dict
-from dataclasses import dataclass
+from typing import Optional, List, Tuple, Dict, Iterable
+from dataclasses import dataclass, replace
+from collections import OrderedDict, namedtuple
 from transformers import (
     AutoTokenizer, 
     AutoModel, 
@@ -34,9 +39,14 @@ from transformers import (
     DistilBertTokenizer
 )
 from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import tiktoken
 
+# Precompiled patterns. The sentence splitter is a single lookbehind on
+# terminal punctuation, which matches in linear time.
+_SENT_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_WHITESPACE_RE = re.compile(r'\s+')
+_ALNUM_RE = re.compile(r'[a-zA-Z0-9]')
+
 
 # =============================================================================
 # Configuration
@@ -47,12 +57,16 @@ class CompressorConfig:
     """Configuration for the from-scratch compressor."""
     # Model settings
     encoder_model: str = "distilbert-base-uncased"
+    use_half_precision: bool = True    # FP16/BF16 autocast for the encoder on MPS/CUDA
     use_query_aware: bool = True
+    sentence_cache_size: int = 4096    # LRU entries of text -> sentence embeddings
+    sentence_cache_path: Optional[str] = None  # .npz persisting that cache across runs
+    result_cache_size: int = 512       # LRU entries of compression results (0 disables)
     
     # Scoring weights
-    attention_weight: float = 0.4      # Weight for attention-based importance
-    semantic_weight: float = 0.3       # Weight for semantic similarity
-    query_weight: float = 0.3          # Weight for query relevance (if query provided)
+    attention_weight: float = 0.5      # Weight for attention-based importance
+    semantic_weight: float = 0.0       # Weight for semantic similarity (0 skips it; near-uniform signal)
+    query_weight: float = 0.5          # Weight for query relevance (if query provided)
     
     # Compression settings
     target_ratio: float = 0.34         # Keep 34% of tokens (66% reduction)
@@ -63,6 +77,9 @@ class CompressorConfig:
     layer_weighting: str = "linear"    # How to weight attention layers: "linear", "exponential", "last"
     preserve_structure: bool = True    # Preserve sentence boundaries
     chunk_size: int = 450              # Max chunk size for long docs (leave room for special tokens)
+    use_onnx: bool = False             # Run the encoder through ONNX Runtime (torch fallback)
+    onnx_dir: str = "./cache/onnx"     # Where exported encoders are stored
+    batch_size: int = 8                # Chunks per batched encoder forward pass
     
     # Position bias mitigation (from LongLLMLingua)
     use_position_bias: bool = True
@@ -75,8 +92,8 @@ class CompressionResult:
     """Result from compression."""
     original_text: str
     compressed_text: str
-    original_tokens: int
-    compressed_tokens: int
+    original_tokens: int               # Encoder tokens of the full text, special tokens
+    compressed_tokens: int             # excluded (tiktoken tokens if recounted)
     token_scores: np.ndarray
     kept_indices: List[int]
     compression_ratio: float
@@ -86,6 +103,135 @@ class CompressionResult:
         return (1 - self.compression_ratio) * 100
 
 
+# Result-cache statistics, in the shape of functools.lru_cache's cache_info()
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+# =============================================================================
+# Shared Models
+# =============================================================================
+
+# Loaded lazily and shared by every scorer (and the eval harness), so two
+# compressors do not each hold their own copy
+_semantic_model = None
+_token_encoder = None
+
+def get_semantic_model() -> SentenceTransformer:
+    """Get or load the shared sentence-embedding model."""
+    global _semantic_model
+    if _semantic_model is None:
+        print("Loading semantic model for query-aware scoring...")
+        _semantic_model = SentenceTransformer("all-MiniLM-L6-v2")
+    return _semantic_model
+
+
+def get_token_encoder():
+    """Get or load the shared tiktoken encoder (GPT-4o-mini tokenizer)."""
+    global _token_encoder
+    if _token_encoder is None:
+        _token_encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+    return _token_encoder
+
+
+# =============================================================================
+# Scoring Kernels
+# =============================================================================
+
+def _normalize(x: torch.Tensor) -> torch.Tensor:
+    """Min-max normalize to [0, 1]; constant inputs map to all ones."""
+    x_min, x_max = x.min(), x.max()
+    return torch.where(
+        x_max > x_min,
+        (x - x_min) / (x_max - x_min + 1e-8),
+        torch.ones_like(x)
+    )
+
+
+def _position_bias(scores: torch.Tensor, boost_start: float, boost_end: float) -> torch.Tensor:
+    """
+    Apply position bias mitigation from LongLLMLingua.
+    
+    LLMs have U-shaped attention: they recall best at start and end.
+    We boost importance of tokens at these positions.
+    """
+    n = len(scores)
+    if n < 10:
+        return scores
+    
+    # Create position weights (U-shaped)
+    position_weights = torch.ones(n, device=scores.device)
+    
+    # Boost start (first 10%)
+    start_region = int(n * 0.1)
+    position_weights[:start_region] = boost_start
+    
+    # Boost end (last 10%)
+    end_region = int(n * 0.9)
+    position_weights[end_region:] = boost_end
+    
+    return scores * position_weights
+
+
+def _build_token_penalties(tokenizer) -> np.ndarray:
+    """
+    Precompute a score multiplier for every vocabulary id: 0 for special
+    tokens, 0.5 for tokens without alphanumerics, 0.8 for subword
+    continuations and 1 otherwise.
+    """
+    vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    search = _ALNUM_RE.search
+    has_content = np.array([tok is not None and search(tok) is not None for tok in vocab])
+    is_subword = np.array([tok is not None and tok.startswith("##") for tok in vocab])
+    
+    penalties = np.where(~has_content, 0.5, np.where(is_subword, 0.8, 1.0)).astype(np.float32)
+    penalties[tokenizer.all_special_ids] = 0.0
+    return penalties
+
+
+def _sentence_ends(text: str) -> np.ndarray:
+    """Character offset where each sentence of text ends (as split by _SENT_SPLIT_RE)."""
+    return np.array(
+        [m.start() for m in _SENT_SPLIT_RE.finditer(text)] + [len(text)], dtype=np.int32
+    )
+
+
+def _pack_sentences(sentences: List[str], lengths: np.ndarray, limit: int) -> List[str]:
+    """
+    Greedily pack consecutive sentences into chunks of at most ``limit``
+    tokens, given each sentence's token count (a longer sentence becomes a
+    chunk of its own).
+    
+    Works on token-count prefix sums: each chunk extends to the last sentence
+    that still fits, found by binary search, so there is one Python
+    iteration per chunk rather than per sentence.
+    """
+    cum = np.cumsum(lengths)
+    searchsorted = np.searchsorted
+    
+    chunks = []
+    start = 0
+    while start < len(sentences):
+        base = cum[start - 1] if start else 0
+        end = max(int(searchsorted(cum, base + limit, side='right')), start + 1)
+        chunks.append(" ".join(sentences[start:end]))
+        start = end
+    return chunks
+
+
+class _OnnxEncoder(nn.Module):
+    """Flattens encoder outputs to (last_hidden_state, *attentions) for ONNX export."""
+    
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+    
+    def forward(self, input_ids: torch.Tensor, attention_mask: torch.Tensor):
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=attention_mask, output_attentions=True
+        )
+        return (outputs.last_hidden_state, *outputs.attentions)
+
+
 # =============================================================================
 # Token Importance Scorer
 # =============================================================================
@@ -103,59 +249,198 @@ class TokenImportanceScorer:
     
     def __init__(self, config: CompressorConfig):
         self.config = config
-        self.device = "mps" if torch.backends.mps.is_available() else "cpu"
+        if torch.backends.mps.is_available():
+            self.device = "mps"
+        elif torch.cuda.is_available():
+            self.device = "cuda"
+        else:
+            self.device = "cpu"
+        
+        # Low-precision autocast for the encoder forward (scoring is robust to it)
+        if not config.use_half_precision or self.device == "cpu":
+            self.autocast_dtype = None
+        elif self.device == "cuda" and torch.cuda.is_bf16_supported():
+            self.autocast_dtype = torch.bfloat16
+        else:
+            self.autocast_dtype = torch.float16
         
         # Load encoder model
         print(f"Loading encoder: {config.encoder_model}...")
         self.tokenizer = AutoTokenizer.from_pretrained(config.encoder_model)
         self.model = AutoModel.from_pretrained(
             config.encoder_model, 
-            output_attentions=True
+            output_attentions=True,
+            attn_implementation="eager"
         ).to(self.device)
         self.model.eval()
         
-        # Semantic model for query relevance
-        if config.use_query_aware:
-            print("Loading semantic model for query-aware scoring...")
-            self.semantic_model = SentenceTransformer("all-MiniLM-L6-v2")
-        else:
-            self.semantic_model = None
+        # Layer weighting for attention aggregation
+        num_layers = self.model.config.num_hidden_layers
+        if config.layer_weighting == "linear":
+            self.layer_weights = torch.linspace(0.3, 1.0, num_layers).tolist()
+        elif config.layer_weighting == "exponential":
+            self.layer_weights = torch.exp(torch.linspace(-1, 0, num_layers)).tolist()
+        else:  # "last"
+            self.layer_weights = [0.0] * (num_layers - 1) + [1.0]
+        
+        # Optional ONNX Runtime encoder (exported before the hooks below are attached)
+        self.onnx_session = self._export_onnx() if config.use_onnx else None
+        
+        # Fold each layer's attention map into a running weighted sum as soon as
+        # it is produced, then drop it, so only one layer's map is alive at a time.
+        # Hooks are prepended so they run before transformers' own output capture.
+        self._attn_received = None  # (batch, heads, seq), filled during forward
+        self._query_mask = None     # (batch, seq), set before forward
+        attention_modules = [
+            m for m in self.model.modules() if "SelfAttention" in type(m).__name__
+        ]
+        for layer_idx, module in enumerate(attention_modules):
+            module.register_forward_hook(self._make_attention_hook(layer_idx), prepend=True)
+        
+        # Special-token / non-content / subword multipliers, gathered by token id
+        self.token_penalties = torch.from_numpy(_build_token_penalties(self.tokenizer)).to(self.device)
+        self.special_ids = np.asarray(self.tokenizer.all_special_ids, dtype=np.int64)
         
-        # Token counter
-        self.tiktoken_encoder = tiktoken.encoding_for_model("gpt-4o-mini")
+        # LRU of text hash -> sentence embeddings. Embeddings are query-independent,
+        # so re-runs and new queries over the same text only encode the query.
+        self._sent_emb_cache: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        if config.sentence_cache_path:
+            self.load_sentence_cache(config.sentence_cache_path)
+    
+    @property
+    def semantic_model(self) -> Optional[SentenceTransformer]:
+        """Semantic model for query relevance (shared, loaded on first use)."""
+        return get_semantic_model() if self.config.use_query_aware else None
+    
+    @property
+    def tiktoken_encoder(self):
+        """Token counter (shared, loaded on first use)."""
+        return get_token_encoder()
     
     def count_tokens(self, text: str) -> int:
         """Count tokens using tiktoken (GPT-4 tokenizer)."""
         return len(self.tiktoken_encoder.encode(text, disallowed_special=()))
     
-    def _get_attention_scores(self, hidden_states, attentions) -> np.ndarray:
+    def _autocast(self):
+        """Autocast context for the encoder forward, or a no-op in FP32."""
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device, dtype=self.autocast_dtype)
+    
+    def _accumulate_attention(self, layer_idx: int, attn: torch.Tensor):
         """
-        Extract attention-based importance scores.
+        Add one layer's weighted attention to the running sum.
         
-        We aggregate attention across all layers and heads, with higher
-        weight given to later layers (which capture more semantic info).
+        attn: (batch, heads, seq, seq). We sum over source (query) positions,
+        skipping padded rows, so each token gets the attention it receives.
+        """
+        # Upcast to FP32 in case the forward ran under half-precision autocast
+        received = (attn.float() * self._query_mask[:, None, :, None]).sum(dim=2)
+        weighted = self.layer_weights[layer_idx] * received
+        if self._attn_received is None:
+            self._attn_received = weighted
+        else:
+            self._attn_received = self._attn_received + weighted
+    
+    def _make_attention_hook(self, layer_idx: int):
+        def hook(module, args, output):
+            if not isinstance(output, tuple) or len(output) < 2 or output[1] is None:
+                return None
+            self._accumulate_attention(layer_idx, output[1])
+            # Drop the attention map so the model does not keep it
+            return (output[0], None) + tuple(output[2:])
+        return hook
+    
+    def _export_onnx(self):
         """
-        # Stack all attention layers: (num_layers, batch, heads, seq, seq)
-        attn_stack = torch.stack(attentions).squeeze(1)  # Remove batch dim
-        num_layers = attn_stack.shape[0]
+        Export the encoder to ONNX (once per model, with dynamic batch and
+        sequence axes) and load it into an onnxruntime session.
         
-        # Layer weighting
-        if self.config.layer_weighting == "linear":
-            weights = torch.linspace(0.3, 1.0, num_layers).to(self.device)
-        elif self.config.layer_weighting == "exponential":
-            weights = torch.exp(torch.linspace(-1, 0, num_layers)).to(self.device)
-        else:  # "last"
-            weights = torch.zeros(num_layers).to(self.device)
-            weights[-1] = 1.0
+        Returns None, keeping the torch encoder, if onnxruntime is missing.
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            print("onnxruntime not installed, using the torch encoder")
+            return None
+        
+        num_layers = len(self.layer_weights)
+        path = os.path.join(
+            self.config.onnx_dir, self.config.encoder_model.replace("/", "__") + ".onnx"
+        )
+        if not os.path.exists(path):
+            print(f"Exporting encoder to ONNX: {path}...")
+            os.makedirs(self.config.onnx_dir, exist_ok=True)
+            dummy = self.tokenizer(["Export the encoder."], return_tensors="pt").to(self.device)
+            dynamic_axes = {"input_ids": {0: "batch", 1: "seq"}, "attention_mask": {0: "batch", 1: "seq"}}
+            output_names = ["last_hidden_state"] + [f"attention_{l}" for l in range(num_layers)]
+            for name in output_names:
+                dynamic_axes[name] = {0: "batch", 1: "seq"} if name == "last_hidden_state" else {0: "batch", 2: "seq", 3: "seq"}
+            torch.onnx.export(
+                _OnnxEncoder(self.model),
+                (dummy["input_ids"], dummy["attention_mask"]),
+                path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+                dynamo=False
+            )
+        
+        available = ort.get_available_providers()
+        providers = [
+            p for p in ("CoreMLExecutionProvider", "CUDAExecutionProvider", "CPUExecutionProvider")
+            if p in available
+        ]
+        return ort.InferenceSession(path, providers=providers)
+    
+    def _forward(self, inputs) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Run the encoder on a tokenized batch.
+        
+        Returns:
+            last_hidden_state: (batch, seq, hidden)
+            attn_received: (batch, heads, seq) layer-weighted attention received
+        """
+        self._query_mask = inputs["attention_mask"].float()
+        self._attn_received = None
+        
+        if self.onnx_session is not None:
+            last_hidden_state, *attentions = self.onnx_session.run(None, {
+                "input_ids": inputs["input_ids"].cpu().numpy(),
+                "attention_mask": inputs["attention_mask"].cpu().numpy(),
+            })
+            for layer_idx, attn in enumerate(attentions):
+                self._accumulate_attention(layer_idx, torch.from_numpy(attn).to(self.device))
+            last_hidden_state = torch.from_numpy(last_hidden_state).to(self.device)
+        else:
+            # Hooks accumulate attention into self._attn_received
+            with torch.inference_mode(), self._autocast():
+                outputs = self.model(**inputs)
+                if self._attn_received is None:
+                    # Architecture without hookable self-attention modules
+                    for layer_idx, attn in enumerate(outputs.attentions):
+                        self._accumulate_attention(layer_idx, attn)
+            last_hidden_state = outputs.last_hidden_state
+        
+        attn_received = self._attn_received
+        self._attn_received = None
+        return last_hidden_state, attn_received
+    
+    def _get_attention_scores(self, attn_received: torch.Tensor) -> torch.Tensor:
+        """
+        Extract attention-based importance scores.
         
-        # Weight and average: sum over source positions, average over layers and heads
-        weights = weights.view(-1, 1, 1, 1)
-        weighted_attn = (attn_stack * weights).sum(dim=2)  # Sum over source (attended-to)
-        scores = weighted_attn.mean(dim=(0, 1))  # Average over layers and heads
+        We aggregate attention across all layers and heads, with higher
+        weight given to later layers (which capture more semantic info).
         
-        return scores.cpu().numpy()
+        attn_received: (heads, seq) layer-weighted attention received by
+        each token, summed over layers by the forward hooks.
+        """
+        # Average over layers and heads
+        return attn_received.mean(dim=0) / len(self.layer_weights)
     
-    def _get_semantic_scores(self, hidden_states) -> np.ndarray:
+    def _get_semantic_scores(self, hidden_states) -> torch.Tensor:
         """
         Compute semantic importance: how much each token contributes to
         the overall sentence meaning.
@@ -163,15 +448,101 @@ class TokenImportanceScorer:
         We measure cosine similarity between each token embedding and
         the mean sentence embedding.
         """
-        # Get token embeddings and sentence embedding
-        token_embs = hidden_states.squeeze(0).cpu().numpy()  # (seq_len, hidden)
-        sent_emb = hidden_states.mean(dim=1).cpu().numpy()   # (1, hidden)
+        # Get token embeddings and sentence embedding (kept on device)
+        hidden_states = hidden_states.float()
+        token_embs = hidden_states.squeeze(0)  # (seq_len, hidden)
+        sent_emb = hidden_states.mean(dim=1)   # (1, hidden)
         
         # Cosine similarity
-        scores = cosine_similarity(token_embs, sent_emb.reshape(1, -1)).squeeze()
+        scores = F.cosine_similarity(token_embs, sent_emb.expand_as(token_embs), dim=-1)
         return scores
     
-    def _get_query_scores(self, text: str, query: str, token_texts: List[str]) -> np.ndarray:
+    def _encode_sentences(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        Sentence embeddings for each text. Cached texts are served from the
+        LRU; the sentences of all other texts are encoded in a single
+        batched call.
+        """
+        md5 = hashlib.md5
+        keys = [md5(text.encode()).digest() for text in texts]
+        cache = self._sent_emb_cache
+        found = {}
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key in cache:
+                cache.move_to_end(key)
+                found[key] = cache[key]
+            else:
+                misses[key] = text
+        
+        if misses:
+            per_text = [_SENT_SPLIT_RE.split(text) for text in misses.values()]
+            all_sentences = [sent for sentences in per_text for sent in sentences]
+            all_embs = np.asarray(
+                self.semantic_model.encode(all_sentences, batch_size=64, show_progress_bar=False),
+                dtype=np.float32
+            )
+            
+            bounds = np.cumsum([0] + [len(sentences) for sentences in per_text])
+            for key, a, b in zip(misses, bounds[:-1], bounds[1:]):
+                found[key] = cache[key] = all_embs[a:b]
+            while len(cache) > self.config.sentence_cache_size:
+                cache.popitem(last=False)
+        
+        return [found[key] for key in keys]
+    
+    def save_sentence_cache(self, path: str):
+        """
+        Write the sentence-embedding cache to an .npz file. The file is written
+        under a temporary name and renamed into place, so concurrent writers
+        (e.g. several server workers) never leave a partial file behind.
+        """
+        if not self._sent_emb_cache:
+            return
+        embs = list(self._sent_emb_cache.values())
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(
+                    f,
+                    # MD5 digests as raw bytes (fixed-width bytes arrays strip trailing NULs)
+                    keys=np.frombuffer(b"".join(self._sent_emb_cache), dtype=np.uint8).reshape(-1, 16),
+                    bounds=np.cumsum([0] + [len(e) for e in embs]),
+                    embeddings=np.concatenate(embs)
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    
+    def load_sentence_cache(self, path: str):
+        """
+        Fill the sentence-embedding cache from a file written by
+        save_sentence_cache. An unreadable file leaves the cache empty.
+        """
+        if not os.path.exists(path):
+            return
+        try:
+            with np.load(path) as cached:
+                keys, bounds, embs = cached["keys"], cached["bounds"], cached["embeddings"]
+        except Exception as e:
+            print(f"Ignoring unreadable sentence cache {path}: {e}")
+            return
+        for key, a, b in zip(keys, bounds[:-1], bounds[1:]):
+            self._sent_emb_cache[key.tobytes()] = embs[a:b]
+        while len(self._sent_emb_cache) > self.config.sentence_cache_size:
+            self._sent_emb_cache.popitem(last=False)
+    
+    def _get_query_scores(
+        self,
+        text: str,
+        query: str,
+        token_starts: np.ndarray,
+        query_emb: Optional[np.ndarray] = None,
+        sent_embs: Optional[np.ndarray] = None
+    ) -> np.ndarray:
         """
         Compute query relevance scores (OPTIMIZED).
         
@@ -180,157 +551,213 @@ class TokenImportanceScorer:
         
         Optimization: Use batch encoding and sentence-level scoring instead
         of per-token encoding to reduce from O(n) to O(1) encoder calls.
+        Tokens are assigned to sentences by their character offsets with a
+        single vectorized searchsorted. Callers scoring several chunks pass
+        a precomputed query_emb / sent_embs so the encoder runs once.
         """
         if self.semantic_model is None:
-            return np.zeros(len(token_texts))
+            return np.zeros(len(token_starts), dtype=np.float32)
         
         # Get query embedding (single encode call)
-        query_emb = self.semantic_model.encode([query], show_progress_bar=False)[0]
+        if query_emb is None:
+            query_emb = self.semantic_model.encode([query], show_progress_bar=False)[0]
         
         # Instead of per-token encoding, score at sentence/phrase level
         # Split text into sentences and batch encode
-        sentences = re.split(r'(?<=[.!?])\s+', text)
+        sentences = _SENT_SPLIT_RE.split(text)
         if not sentences:
-            return np.ones(len(token_texts)) * 0.5
-        
-        # Batch encode all sentences at once (single call)
-        sent_embs = self.semantic_model.encode(sentences, show_progress_bar=False)
-        
-        # Compute sentence scores
-        sent_scores = cosine_similarity(query_emb.reshape(1, -1), sent_embs)[0]
-        
-        # Map sentence scores back to tokens
-        scores = np.zeros(len(token_texts))
-        token_idx = 0
-        reconstructed = ""
-        
-        for sent_idx, sent in enumerate(sentences):
-            sent_tokens = sent.lower().split()
-            # Find how many tokens belong to this sentence (approximate)
-            tokens_in_sent = 0
-            for tok in token_texts[token_idx:]:
-                clean_tok = tok.replace("##", "").lower()
-                if clean_tok in reconstructed or len(clean_tok) < 2:
-                    tokens_in_sent += 1
-                    continue
-                reconstructed += " " + tok
-                tokens_in_sent += 1
-                if len(reconstructed.split()) >= len(sent_tokens):
-                    break
-            
-            # Assign sentence score to all its tokens
-            end_idx = min(token_idx + max(tokens_in_sent, 1), len(scores))
-            scores[token_idx:end_idx] = sent_scores[sent_idx]
-            token_idx = end_idx
-            reconstructed = ""
-            
-            if token_idx >= len(scores):
-                break
-        
-        # Fill remaining tokens with average score
-        if token_idx < len(scores):
-            scores[token_idx:] = np.mean(sent_scores)
+            return np.full(len(token_starts), 0.5, dtype=np.float32)
         
-        return scores
-    
-    def _apply_position_bias(self, scores: np.ndarray) -> np.ndarray:
-        """
-        Apply position bias mitigation from LongLLMLingua.
-        
-        LLMs have U-shaped attention: they recall best at start and end.
-        We boost importance of tokens at these positions.
-        """
-        n = len(scores)
-        if n < 10:
-            return scores
-        
-        # Create position weights (U-shaped)
-        position_weights = np.ones(n)
+        # Batch encode all sentences at once (single call, cached per text)
+        if sent_embs is None:
+            sent_embs = self._encode_sentences([text])[0]
         
-        # Boost start (first 10%)
-        start_region = int(n * 0.1)
-        position_weights[:start_region] = self.config.position_boost_start
+        # Compute sentence scores: cosine similarity as one normalized matmul
+        q = query_emb / (np.linalg.norm(query_emb) + 1e-8)
+        S = sent_embs / (np.linalg.norm(sent_embs, axis=1, keepdims=True) + 1e-8)
+        sent_scores = S @ q
         
-        # Boost end (last 10%)
-        end_region = int(n * 0.9)
-        position_weights[end_region:] = self.config.position_boost_end
+        # Map sentence scores back to tokens: each token belongs to the first
+        # sentence ending after the token's start offset
+        sent_ends = _sentence_ends(text)
+        sent_idx = np.searchsorted(sent_ends, token_starts, side='right')
+        scores = sent_scores[np.clip(sent_idx, 0, len(sent_scores) - 1)]
         
-        return scores * position_weights
+        return scores
     
-    def score_tokens(
-        self, 
-        text: str, 
-        query: Optional[str] = None
+    def _score_row(
+        self,
+        text: str,
+        query: Optional[str],
+        token_ids: np.ndarray,
+        token_starts: np.ndarray,
+        hidden_states: Optional[torch.Tensor],
+        attn_received: torch.Tensor,
+        query_emb: Optional[np.ndarray] = None,
+        sent_embs: Optional[np.ndarray] = None
     ) -> Tuple[np.ndarray, List[str], List[int]]:
         """
-        Score all tokens in text for importance.
+        Fuse all signals into per-token scores for one (unpadded) row.
         
-        Returns:
-            scores: numpy array of importance scores per token
-            tokens: list of token strings
-            token_ids: list of token IDs
+        Normalization, fusion and position bias run on the model's device;
+        only the final per-token score vector is copied back to the host.
         """
-        # Tokenize
-        inputs = self.tokenizer(
-            text, 
-            return_tensors="pt", 
-            truncation=True, 
-            max_length=self.config.chunk_size
-        ).to(self.device)
-        
-        token_ids = inputs["input_ids"][0].cpu().numpy()
         tokens = self.tokenizer.convert_ids_to_tokens(token_ids)
         
-        # Forward pass
-        with torch.no_grad():
-            outputs = self.model(**inputs)
-        
-        # Get attention and semantic scores
-        attn_scores = self._get_attention_scores(outputs.last_hidden_state, outputs.attentions)
-        sem_scores = self._get_semantic_scores(outputs.last_hidden_state)
-        
-        # Normalize scores
-        def normalize(x):
-            if x.max() == x.min():
-                return np.ones_like(x)
-            return (x - x.min()) / (x.max() - x.min() + 1e-8)
-        
-        attn_scores = normalize(attn_scores)
-        sem_scores = normalize(sem_scores)
+        # Get attention and semantic scores (semantic only when weighted)
+        attn_scores = _normalize(self._get_attention_scores(attn_received))
+        sem_scores = None
+        if self.config.semantic_weight > 0:
+            sem_scores = _normalize(self._get_semantic_scores(hidden_states))
         
         # Combine scores
         if query and self.config.use_query_aware:
-            query_scores = self._get_query_scores(text, query, tokens)
-            query_scores = normalize(query_scores)
+            query_scores = self._get_query_scores(text, query, token_starts, query_emb, sent_embs)
+            query_scores = _normalize(
+                torch.as_tensor(query_scores, dtype=torch.float32, device=self.device)
+            )
             
             scores = (
                 self.config.attention_weight * attn_scores +
-                self.config.semantic_weight * sem_scores +
                 self.config.query_weight * query_scores
             )
+            if sem_scores is not None:
+                scores = scores + self.config.semantic_weight * sem_scores
         else:
             # Re-weight without query
             total = self.config.attention_weight + self.config.semantic_weight
-            scores = (
-                (self.config.attention_weight / total) * attn_scores +
-                (self.config.semantic_weight / total) * sem_scores
-            )
+            scores = (self.config.attention_weight / total) * attn_scores
+            if sem_scores is not None:
+                scores = scores + (self.config.semantic_weight / total) * sem_scores
         
         # Apply position bias
         if self.config.use_position_bias:
-            scores = self._apply_position_bias(scores)
+            scores = _position_bias(
+                scores, self.config.position_boost_start, self.config.position_boost_end
+            )
         
         # Penalize special tokens and non-content tokens
-        special_ids = set(self.tokenizer.all_special_ids)
-        for i, (tok, tid) in enumerate(zip(tokens, token_ids)):
-            if tid in special_ids:
-                scores[i] = 0.0
-            elif not re.search(r'[a-zA-Z0-9]', tok):
-                scores[i] *= 0.5
-            elif tok.startswith("##"):  # Subword continuation
-                scores[i] *= 0.8
+        scores = scores * self.token_penalties[torch.from_numpy(token_ids).to(self.device)]
+        
+        return _normalize(scores).cpu().numpy(), tokens, token_ids.tolist()
+    
+    def score_tokens_batch(
+        self,
+        texts: List[str],
+        query: Optional[str] = None,
+        query_emb: Optional[np.ndarray] = None,
+        queries: Optional[List[Optional[str]]] = None
+    ) -> List[Tuple[np.ndarray, List[str], List[int]]]:
+        """
+        Score tokens for several texts with batched forward passes.
+        
+        Distinct texts are sorted by length so each batch pads as little as
+        possible, padded to a common length and run through the encoder
+        ``batch_size`` rows at a time; padded positions are masked out per row
+        before scoring. A text repeated in ``texts`` (e.g. with different
+        queries) goes through the encoder once and is scored per query.
+        
+        ``query`` applies to every text; ``queries`` gives one (optional)
+        query per text instead. For query-aware scoring each distinct query
+        is encoded once (query_emb, if given, is the embedding of ``query``)
+        and the sentences of all uncached texts are encoded in a single call.
+        
+        Returns:
+            One (scores, tokens, token_ids) tuple per input text, in input order
+        """
+        if queries is None:
+            queries = [query] * len(texts)
+        
+        query_embs = [None] * len(texts)
+        sent_embs = [None] * len(texts)
+        if any(queries) and self.config.use_query_aware and self.semantic_model is not None:
+            unique = list(dict.fromkeys(q for q in queries if q))
+            known = {query: query_emb} if query and query_emb is not None else {}
+            missing = [q for q in unique if q not in known]
+            if missing:
+                known.update(zip(missing, self.semantic_model.encode(missing, show_progress_bar=False)))
+            
+            with_query = [j for j, q in enumerate(queries) if q]
+            for j, embs in zip(with_query, self._encode_sentences([texts[j] for j in with_query])):
+                query_embs[j] = known[queries[j]]
+                sent_embs[j] = embs
+        
+        # Positions of each distinct text in the input
+        positions: Dict[str, List[int]] = {}
+        for j, text in enumerate(texts):
+            positions.setdefault(text, []).append(j)
+        distinct = list(positions)
+        
+        order = np.argsort([len(text) for text in distinct], kind="stable")
+        results = [None] * len(texts)
+        
+        # Loop-invariant lookups bound once
+        batch_size = self.config.batch_size
+        use_hidden = self.config.semantic_weight > 0
+        score_row = self._score_row
+        
+        for start in range(0, len(distinct), batch_size):
+            batch = [distinct[k] for k in order[start:start + batch_size]]
+            
+            # Tokenize
+            inputs = self.tokenizer(
+                batch,
+                return_tensors="pt",
+                padding=True,
+                truncation=True,
+                max_length=self.config.chunk_size,
+                return_offsets_mapping=True
+            )
+            offset_mapping = inputs.pop("offset_mapping")
+            inputs = inputs.to(self.device)
+            
+            # Forward pass
+            last_hidden_state, attn_received = self._forward(inputs)
+            
+            attention_mask, input_ids = inputs["attention_mask"], inputs["input_ids"]
+            for i, text in enumerate(batch):
+                mask = attention_mask[i].bool()
+                token_ids = input_ids[i][mask].cpu().numpy()
+                token_starts = offset_mapping[i][mask.cpu()][:, 0].to(torch.int32).numpy()
+                hidden_states = None
+                if use_hidden:
+                    hidden_states = last_hidden_state[i][mask].unsqueeze(0)
+                row_attn = attn_received[i][:, mask]
+                for j in positions[text]:
+                    results[j] = score_row(
+                        text, queries[j], token_ids, token_starts, hidden_states, row_attn,
+                        query_embs[j], sent_embs[j]
+                    )
+        
+        return results
+    
+    def score_tokens(
+        self, 
+        text: str, 
+        query: Optional[str] = None,
+        query_emb: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, List[str], List[int]]:
+        """
+        Score all tokens in text for importance.
         
-        return normalize(scores), tokens, token_ids.tolist()
+        Returns:
+            scores: numpy array of importance scores per token
+            tokens: list of token strings
+            token_ids: list of token IDs
+        """
+        return self.score_tokens_batch([text], query, query_emb)[0]
+    
+    def count_encoder_tokens(self, texts: List[str]) -> np.ndarray:
+        """Encoder tokens in each text, without special tokens or truncation."""
+        if not texts:
+            return np.zeros(0, dtype=np.int64)
+        input_ids = self.tokenizer(texts, add_special_tokens=False, verbose=False)["input_ids"]
+        return np.fromiter(map(len, input_ids), dtype=np.int64, count=len(texts))
+    
+    def count_kept_tokens(self, token_ids: List[int], kept: np.ndarray) -> int:
+        """Kept tokens that are not special tokens (those are dropped on decode)."""
+        kept_ids = np.asarray(token_ids, dtype=np.int64)[kept]
+        return int(kept.size - np.isin(kept_ids, self.special_ids).sum())
 
 
 # =============================================================================
@@ -351,12 +778,77 @@ class ScratchCompressor:
     def __init__(self, config: Optional[CompressorConfig] = None):
         self.config = config or CompressorConfig()
         self.scorer = TokenImportanceScorer(self.config)
+        # LRU of (method, text, query, target_ratio, recount) -> result, shared by
+        # compress(), compress_batch() and compress_chunks() so repeated requests
+        # are served from memory on every path (including the batching server)
+        self._results: "OrderedDict[tuple, CompressionResult]" = OrderedDict()
+        self._results_lock = threading.Lock()
+        self._result_hits = 0
+        self._result_misses = 0
+    
+    def warmup(self, corpus: Iterable[str] = ()):
+        """
+        Load the lazily initialized models and run one forward pass, so the
+        first request does not pay for them, then pre-encode the sentences
+        of ``corpus`` for query-aware scoring. The sentence-embedding cache
+        is saved to config.sentence_cache_path, if set, for the next start.
+        """
+        self.scorer.tiktoken_encoder
+        self.compress_batch(["Warm up the encoder."], queries=["Warm up"])
+        
+        # Only the most recent sentence_cache_size distinct texts survive the
+        # LRU, so encoding any earlier ones would be wasted work (and with a
+        # zero-size cache, all of them would be)
+        cache_size = self.config.sentence_cache_size
+        texts = list(dict.fromkeys(corpus))[-cache_size:] if cache_size > 0 else []
+        if texts and self.scorer.semantic_model is not None:
+            # One batched encode over every sentence of the corpus
+            self.scorer._encode_sentences(texts)
+        if self.config.sentence_cache_path:
+            self.scorer.save_sentence_cache(self.config.sentence_cache_path)
+    
+    def cache_info(self) -> "CacheInfo":
+        """Hit/miss statistics of the result cache."""
+        with self._results_lock:
+            return CacheInfo(
+                self._result_hits, self._result_misses,
+                self.config.result_cache_size, len(self._results)
+            )
+    
+    def cache_clear(self):
+        """Drop all cached results and reset the statistics."""
+        with self._results_lock:
+            self._results.clear()
+            self._result_hits = self._result_misses = 0
+    
+    def _cached_result(self, key: tuple) -> Optional[CompressionResult]:
+        """Look up a cached result, counting the hit or miss."""
+        with self._results_lock:
+            result = self._results.get(key)
+            if result is None:
+                self._result_misses += 1
+            else:
+                self._result_hits += 1
+                self._results.move_to_end(key)
+            return result
+    
+    def _store_result(self, key: tuple, result: CompressionResult):
+        """Add a result to the cache, evicting the least recently used."""
+        if self.config.result_cache_size <= 0:
+            return
+        with self._results_lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.config.result_cache_size:
+                self._results.popitem(last=False)
     
     def compress(
         self,
         text: str,
         query: Optional[str] = None,
-        target_ratio: Optional[float] = None
+        target_ratio: Optional[float] = None,
+        query_emb: Optional[np.ndarray] = None,
+        recount_with_tiktoken: bool = False
     ) -> CompressionResult:
         """
         Compress text by keeping only the most important tokens.
@@ -365,17 +857,155 @@ class ScratchCompressor:
             text: Input text to compress
             query: Optional query for query-aware compression
             target_ratio: Override config target ratio (0.34 = 66% reduction)
+            query_emb: Optional precomputed query embedding, to reuse across calls
+            recount_with_tiktoken: Report token counts in tiktoken (GPT-4) units
+                instead of encoder tokens
         
         Returns:
-            CompressionResult with compressed text and metrics
+            CompressionResult with compressed text and metrics. Results are
+            cached and shared between identical calls; treat them as read-only.
         """
-        target = target_ratio or self.config.target_ratio
-        
+        if query_emb is not None:
+            # Arrays aren't hashable; precomputed embeddings bypass the cache
+            return self._compress_impl(
+                text, query or "", target_ratio, recount_with_tiktoken, query_emb
+            )
+        key = ("compress", text, query or "", target_ratio, recount_with_tiktoken)
+        result = self._cached_result(key)
+        if result is None:
+            result = self._compress_impl(text, query or "", target_ratio, recount_with_tiktoken)
+            self._store_result(key, result)
+        return result
+    
+    def _compress_impl(
+        self,
+        text: str,
+        query: str,
+        target_ratio: Optional[float],
+        recount_with_tiktoken: bool,
+        query_emb: Optional[np.ndarray] = None
+    ) -> CompressionResult:
+        """Uncached body of compress()."""
         # Score tokens
-        scores, tokens, token_ids = self.scorer.score_tokens(text, query)
+        scores, _, token_ids = self.scorer.score_tokens(text, query, query_emb)
+        orig_tokens = int(self.scorer.count_encoder_tokens([text])[0])
+        
+        result = self._compress_scored(text, scores, token_ids, orig_tokens, target_ratio)
+        return self._recount(result) if recount_with_tiktoken else result
+    
+    def compress_batch(
+        self,
+        texts: List[str],
+        queries: Optional[List[Optional[str]]] = None,
+        target_ratios: Optional[List[Optional[float]]] = None
+    ) -> List[CompressionResult]:
+        """
+        Compress several independent texts, each with its own optional query
+        and target ratio, sharing batched encoder forward passes. Texts longer
+        than chunk_size encoder tokens are truncated, as in compress(); use
+        compress_chunks for long documents.
+        
+        Results share compress()'s cache: only texts without a cached result
+        go through the encoder.
+        """
+        if queries is None:
+            queries = [None] * len(texts)
+        if target_ratios is None:
+            target_ratios = [None] * len(texts)
+        
+        keys = [
+            ("compress", text, query or "", target_ratio, False)
+            for text, query, target_ratio in zip(texts, queries, target_ratios)
+        ]
+        results = [self._cached_result(key) for key in keys]
+        misses = [i for i, result in enumerate(results) if result is None]
+        if misses:
+            scored = self.scorer.score_tokens_batch(
+                [texts[i] for i in misses], queries=[queries[i] for i in misses]
+            )
+            orig_counts = self.scorer.count_encoder_tokens([texts[i] for i in misses]).tolist()
+            for i, (scores, _, token_ids), orig_tokens in zip(misses, scored, orig_counts):
+                results[i] = self._compress_scored(
+                    texts[i], scores, token_ids, orig_tokens, target_ratios[i]
+                )
+                self._store_result(keys[i], results[i])
+        return results
+    
+    def compress_multi(
+        self,
+        text: str,
+        queries: List[Optional[str]],
+        target_ratio: Optional[float] = None,
+        recount_with_tiktoken: bool = False
+    ) -> List[CompressionResult]:
+        """
+        Compress one text once per query (None for query-agnostic), sharing a
+        single encoder forward pass; only the score fusion and token
+        selection run per query.
+        """
+        results = self.compress_batch(
+            [text] * len(queries), queries, [target_ratio] * len(queries)
+        )
+        if recount_with_tiktoken:
+            results = [self._recount(result) for result in results]
+        return results
+    
+    def _recount(self, result: CompressionResult) -> CompressionResult:
+        """Replace encoder token counts with tiktoken counts of the full texts."""
+        orig_count = self.scorer.count_tokens(result.original_text)
+        comp_count = self.scorer.count_tokens(result.compressed_text)
+        return replace(
+            result,
+            original_tokens=orig_count,
+            compressed_tokens=comp_count,
+            compression_ratio=comp_count / orig_count if orig_count > 0 else 1.0
+        )
+    
+    def _compress_scored(
+        self,
+        text: str,
+        scores: np.ndarray,
+        token_ids: List[int],
+        orig_tokens: int,
+        target_ratio: Optional[float] = None
+    ) -> CompressionResult:
+        """
+        Keep the top-scoring tokens of an already scored text. orig_tokens is
+        the encoder token count of the whole text, so input beyond chunk_size
+        that was truncated away still counts as dropped.
+        """
+        kept, compressed = self._select_tokens(scores, token_ids, target_ratio)
+        
+        # Compression in encoder tokens, special tokens excluded (no recount)
+        comp_tokens = self.scorer.count_kept_tokens(token_ids, kept)
+        
+        return CompressionResult(
+            original_text=text,
+            compressed_text=compressed,
+            original_tokens=orig_tokens,
+            compressed_tokens=comp_tokens,
+            token_scores=scores,
+            kept_indices=kept.tolist(),
+            compression_ratio=comp_tokens / orig_tokens if orig_tokens > 0 else 1.0
+        )
+    
+    def _select_tokens(
+        self,
+        scores: np.ndarray,
+        token_ids: List[int],
+        target_ratio: Optional[float] = None
+    ) -> Tuple[np.ndarray, str]:
+        """
+        Pick the top-scoring tokens.
+        
+        Returns:
+            kept: indices of the kept tokens, in order
+            compressed: the kept tokens decoded back to text
+        """
+        target = target_ratio or self.config.target_ratio
         
         # Determine how many tokens to keep
-        orig_tokens = len(tokens)
+        orig_tokens = len(token_ids)
         keep_count = max(
             self.config.min_tokens,
             int(orig_tokens * target)
@@ -385,38 +1015,28 @@ class ScratchCompressor:
         if keep_count >= orig_tokens:
             threshold = 0.0
         else:
-            sorted_scores = np.sort(scores)[::-1]
-            threshold = max(sorted_scores[keep_count - 1], self.config.hard_threshold)
+            # k-th largest score via O(n) selection instead of a full sort
+            kth = orig_tokens - keep_count
+            threshold = max(np.partition(scores, kth)[kth], self.config.hard_threshold)
         
         # Select tokens above threshold
-        kept_indices = [i for i, s in enumerate(scores) if s >= threshold]
+        kept = np.flatnonzero(scores >= threshold)
         
-        # Build compressed text
-        kept_tokens = [tokens[i] for i in kept_indices]
-        compressed = self.scorer.tokenizer.convert_tokens_to_string(kept_tokens)
+        # Build compressed text (decoded by the fast tokenizer backend)
+        kept_ids = np.asarray(token_ids, dtype=np.int32)[kept].tolist()
+        compressed = self.scorer.tokenizer.decode(kept_ids, skip_special_tokens=True)
         
         # Clean up
-        compressed = re.sub(r'\s+', ' ', compressed).strip()
+        compressed = _WHITESPACE_RE.sub(' ', compressed).strip()
         
-        # Calculate actual compression
-        comp_tokens = self.scorer.count_tokens(compressed)
-        orig_count = self.scorer.count_tokens(text)
-        
-        return CompressionResult(
-            original_text=text,
-            compressed_text=compressed,
-            original_tokens=orig_count,
-            compressed_tokens=comp_tokens,
-            token_scores=scores,
-            kept_indices=kept_indices,
-            compression_ratio=comp_tokens / orig_count if orig_count > 0 else 1.0
-        )
+        return kept, compressed
     
     def compress_chunks(
         self,
         text: str,
         query: Optional[str] = None,
-        target_ratio: Optional[float] = None
+        target_ratio: Optional[float] = None,
+        recount_with_tiktoken: bool = False
     ) -> CompressionResult:
         """
         Compress long text by processing in chunks.
@@ -425,51 +1045,75 @@ class ScratchCompressor:
         1. Split into chunks at sentence boundaries
         2. Compress each chunk independently
         3. Rejoin the results
-        """
-        # Simple sentence splitting
-        sentences = re.split(r'(?<=[.!?])\s+', text)
         
-        chunks = []
-        current_chunk = []
-        current_len = 0
-        
-        for sent in sentences:
-            sent_len = len(sent.split())
-            if current_len + sent_len > self.config.chunk_size * 0.8:
-                if current_chunk:
-                    chunks.append(" ".join(current_chunk))
-                current_chunk = [sent]
-                current_len = sent_len
-            else:
-                current_chunk.append(sent)
-                current_len += sent_len
+        Token counts are encoder tokens without special tokens unless
+        recount_with_tiktoken is set, in which case the full texts are recounted once. Results are
+        cached like compress()'s.
+        """
+        key = ("compress_chunks", text, query or "", target_ratio, recount_with_tiktoken)
+        cached = self._cached_result(key)
+        if cached is not None:
+            return cached
         
-        if current_chunk:
-            chunks.append(" ".join(current_chunk))
+        chunks, total_orig = self._split_chunks(text)
         
-        # Compress each chunk
-        compressed_chunks = []
-        total_orig = 0
-        total_comp = 0
+        # Score all chunks in one call: batches are length-sorted across the
+        # whole document and all sentences are embedded in a single encode
+        scored = self.scorer.score_tokens_batch(chunks, query)
         
-        for chunk in chunks:
-            result = self.compress(chunk, query, target_ratio)
-            compressed_chunks.append(result.compressed_text)
-            total_orig += result.original_tokens
-            total_comp += result.compressed_tokens
+        select = self._select_tokens
+        selected = [select(scores, token_ids, target_ratio) for scores, _, token_ids in scored]
         
         # Combine
-        final_text = " ".join(compressed_chunks)
+        final_text = " ".join(compressed for _, compressed in selected)
+        count_kept = self.scorer.count_kept_tokens
+        total_comp = sum(
+            count_kept(token_ids, kept) for (_, _, token_ids), (kept, _) in zip(scored, selected)
+        )
         
-        return CompressionResult(
+        result = CompressionResult(
             original_text=text,
             compressed_text=final_text,
             original_tokens=total_orig,
             compressed_tokens=total_comp,
-            token_scores=np.array([]),  # Not meaningful for multi-chunk
+            token_scores=np.array([], dtype=np.float32),  # Not meaningful for multi-chunk
             kept_indices=[],
             compression_ratio=total_comp / total_orig if total_orig > 0 else 1.0
         )
+        if recount_with_tiktoken:
+            result = self._recount(result)
+        self._store_result(key, result)
+        return result
+    
+    def fits_encoder(self, text: str) -> bool:
+        """Whether text fits in one encoder pass of chunk_size tokens (specials included)."""
+        num_special = self.scorer.tokenizer.num_special_tokens_to_add()
+        return self.scorer.count_encoder_tokens([text])[0] + num_special <= self.config.chunk_size
+    
+    def compress_document(
+        self,
+        text: str,
+        query: Optional[str] = None,
+        target_ratio: Optional[float] = None,
+        recount_with_tiktoken: bool = False
+    ) -> CompressionResult:
+        """compress(), or compress_chunks() when text does not fit in one encoder pass."""
+        if self.fits_encoder(text):
+            return self.compress(text, query, target_ratio, recount_with_tiktoken=recount_with_tiktoken)
+        return self.compress_chunks(text, query, target_ratio, recount_with_tiktoken=recount_with_tiktoken)
+    
+    def _split_chunks(self, text: str) -> Tuple[List[str], int]:
+        """
+        Split text at sentence boundaries into chunks that fit in one encoder
+        pass, packing by encoder token counts so no chunk is truncated (unless
+        a single sentence is longer than chunk_size).
+        
+        Returns the chunks and the text's total encoder token count.
+        """
+        sentences = _SENT_SPLIT_RE.split(text)
+        lengths = self.scorer.count_encoder_tokens(sentences)
+        limit = self.config.chunk_size - self.scorer.tokenizer.num_special_tokens_to_add()
+        return _pack_sentences(sentences, lengths, limit), int(lengths.sum())
 
 
 # =============================================================================
@@ -505,32 +1149,26 @@ def compress(
     """
     compressor = get_compressor()
     
-    # Use chunking for long texts (> 400 words)
-    word_count = len(text.split())
-    if word_count > 400:
-        result = compressor.compress_chunks(text, query, target_ratio)
-    else:
-        result = compressor.compress(text, query, target_ratio)
-    
-    return result.compressed_text
+    # Use chunking for texts longer than one encoder pass
+    return compressor.compress_document(text, query, target_ratio).compressed_text
 
 
 def compress_with_metrics(
     text: str,
     query: Optional[str] = None,
-    target_ratio: float = 0.34
+    target_ratio: float = 0.34,
+    recount_with_tiktoken: bool = True
 ) -> CompressionResult:
     """
     Compress with full metrics returned. Automatically uses chunking for long texts.
+    Token counts are in tiktoken (GPT-4) units unless recount_with_tiktoken=False.
     """
     compressor = get_compressor()
     
-    # Use chunking for long texts
-    word_count = len(text.split())
-    if word_count > 400:
-        return compressor.compress_chunks(text, query, target_ratio)
-    else:
-        return compressor.compress(text, query, target_ratio)
+    # Use chunking for texts longer than one encoder pass
+    return compressor.compress_document(
+        text, query, target_ratio, recount_with_tiktoken=recount_with_tiktoken
+    )
 
 
 # =============================================================================
@@ -560,17 +1198,18 @@ if __name__ == "__main__":
     config = CompressorConfig(target_ratio=0.34)
     compressor = ScratchCompressor(config)
     
-    # Test without query
+    # Compress without and with the query from one encoder pass
+    result, result_qa = compressor.compress_multi(
+        test_text, [None, test_query], recount_with_tiktoken=True
+    )
+    
     print("\n--- Without Query ---")
-    result = compressor.compress(test_text)
     print(f"Original: {result.original_tokens} tokens")
     print(f"Compressed: {result.compressed_tokens} tokens")
     print(f"Reduction: {result.reduction_pct:.1f}%")
     print(f"Output: {result.compressed_text[:200]}...")
     
-    # Test with query
     print("\n--- With Query ---")
-    result_qa = compressor.compress(test_text, query=test_query)
     print(f"Original: {result_qa.original_tokens} tokens")
     print(f"Compressed: {result_qa.compressed_tokens} tokens")
     print(f"Reduction: {result_qa.reduction_pct:.1f}%")
@@ -582,3 +1221,15 @@ if __name__ == "__main__":
     print(f"Bear-1 target: 66% reduction")
     print(f"Our reduction (no query): {result.reduction_pct:.1f}%")
     print(f"Our reduction (with query): {result_qa.reduction_pct:.1f}%")
+    
+    # Long-input check: a text just over one encoder pass is chunked rather
+    # than truncated, so with every token kept its last sentence survives
+    print("\n--- Long Input ---")
+    base, tail = " ".join(test_text.split()), "The final sentence mentions zebras."
+    repeats = 1
+    while compressor.fits_encoder(" ".join([base] * repeats) + " " + tail):
+        repeats += 1
+    long_text = " ".join([base] * repeats) + " " + tail
+    result_long = compressor.compress_document(long_text, target_ratio=1.0)
+    assert "zebras" in result_long.compressed_text, "tail of a long input was dropped"
+    print(f"Original: {result_long.original_tokens} tokens, last sentence kept")
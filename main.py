@@ -1,7 +1,102 @@
-from fastapi import FastAPI
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
 
-app = FastAPI()
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, Field
+import uvicorn
 
-@app.get("/")
-def read_root():
-    return {"message": "Solace AI backend is live!"}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load and warm the compressor once at startup so no request pays for it."""
+    app.state.compressor = None
+    app.state.batcher = None
+    try:
+        # Imported here so the rest of the API runs without the compression deps
+        from compression.batching import BatchingCompressor
+        from compression.scratch import ScratchCompressor, CompressorConfig
+    except ImportError as e:
+        print(f"Compression endpoints disabled: {e}")
+    else:
+        compressor = ScratchCompressor(CompressorConfig(
+            target_ratio=0.34,
+            sentence_cache_path="./cache/sentences.npz"
+        ))
+        await asyncio.to_thread(compressor.warmup)
+        app.state.compressor = compressor
+        app.state.batcher = BatchingCompressor(compressor)
+
+    yield
+
+    if app.state.batcher is not None:
+        await app.state.batcher.close()
+        # Keep the sentences embedded while serving for the next start
+        compressor = app.state.compressor
+        if compressor.config.sentence_cache_path:
+            await asyncio.to_thread(
+                compressor.scorer.save_sentence_cache, compressor.config.sentence_cache_path
+            )
+
+
+# Routes declare a response_model, so FastAPI serializes responses straight to
+# JSON bytes with Pydantic; a custom default_response_class would bypass that
+app = FastAPI(lifespan=lifespan)
+# Gzip bodies over 1 KB for clients sending Accept-Encoding: gzip; others get plain responses
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
+
+
+class StatusResponse(BaseModel):
+    message: str
+
+
+class CompressRequest(BaseModel):
+    text: str
+    query: Optional[str] = None
+    target_ratio: Optional[float] = Field(None, gt=0, le=1)
+
+
+class CompressResponse(BaseModel):
+    compressed_text: str
+    original_tokens: int
+    compressed_tokens: int
+    compression_ratio: float
+
+
+@app.get("/", response_model=StatusResponse)
+async def read_root():
+    return StatusResponse(message="Solace AI backend is live!")
+
+
+@app.post("/compress", response_model=CompressResponse)
+async def compress(body: CompressRequest, request: Request):
+    batcher = request.app.state.batcher
+    if batcher is None:
+        raise HTTPException(status_code=503, detail="Compression is not available")
+
+    result = await batcher.compress(body.text, body.query, body.target_ratio)
+    return CompressResponse(
+        compressed_text=result.compressed_text,
+        original_tokens=result.original_tokens,
+        compressed_tokens=result.compressed_tokens,
+        compression_ratio=result.compression_ratio
+    )
+
+
+if __name__ == "__main__":
+    # Production launch on uvloop + httptools (uvicorn[standard]). Defaults to
+    # one worker: the endpoint is model-bound, and every worker would load its
+    # own DistilBERT + MiniLM onto the same device, split concurrent requests
+    # into smaller dynamic batches, and overwrite the others' sentence cache
+    # on shutdown. Set WEB_CONCURRENCY to run more.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8080,
+        workers=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools",
+        log_level="warning"
+    )